@@ -0,0 +1,107 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+import hashlib
+import orjson
+import os
+import pickle
+
+# Local embedding model used to find notes that say the same thing in different words
+SEMANTIC_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Cosine similarity above which two notes are treated as the same note
+SIMILARITY_THRESHOLD = 0.95
+
+def normalize_text(text: str) -> str:
+    """Canonical newlines and no trailing whitespace, so cosmetic edits don't change a cache key"""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+class ResponseCache:
+    """
+    Exact-match cache of model responses stored on disk, one JSON file per entry.
+    Entries are keyed by a hash of everything that went into the request.
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            return orjson.loads((self.cache_dir / f"{key}.json").read_bytes())
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: dict):
+        # Write to a temporary file and swap it in, so a crash never leaves a half-written entry
+        cache_file = self.cache_dir / f"{key}.json"
+        temp_file = cache_file.with_name(cache_file.name + ".tmp")
+        temp_file.write_bytes(orjson.dumps(value))
+        os.replace(temp_file, cache_file)
+
+    def put_many(self, entries: List[Tuple[str, dict]]):
+        """Store several (key, value) entries. Blocks on the disk, so async callers should run it in a thread"""
+        for key, value in entries:
+            self.put(key, value)
+
+class SemanticCache:
+    """
+    Cache of model responses keyed by note meaning rather than exact text, so paraphrased or
+    near-duplicate notes reuse an earlier response. Kept in memory and persisted with save().
+
+    Needs sentence-transformers and faiss, which are only imported when a SemanticCache is created.
+    """
+
+    def __init__(self, cache_file: Path, scope: str, threshold: float = SIMILARITY_THRESHOLD):
+        """
+        Args:
+            cache_file: Pickle file the cache is loaded from and saved to
+            scope: Hash of the prompt/model the responses came from. A saved cache with a different scope is discarded
+            threshold: Minimum cosine similarity for a hit
+        """
+        import faiss
+        from sentence_transformers import SentenceTransformer
+
+        self.cache_file = cache_file
+        self.scope = scope
+        self.threshold = threshold
+        self.encoder = SentenceTransformer(SEMANTIC_MODEL_NAME)
+
+        # Embeddings are normalized, so inner product is cosine similarity
+        self.index = faiss.IndexFlatIP(self.encoder.get_sentence_embedding_dimension())
+        self.responses = []
+
+        if cache_file.exists():
+            with open(cache_file, "rb") as file:
+                saved_scope, embeddings, responses = pickle.load(file)
+            if saved_scope == scope and len(responses):
+                self.index.add(embeddings)
+                self.responses = responses
+
+    def embed(self, texts: List[str]):
+        """Embed all texts in one pass, one row per text"""
+        return self.encoder.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype("float32")
+
+    def get(self, embedding) -> Optional[dict]:
+        if self.index.ntotal == 0:
+            return None
+
+        scores, ids = self.index.search(embedding.reshape(1, -1), 1)
+        if scores[0][0] < self.threshold:
+            return None
+        return self.responses[ids[0][0]]
+
+    def put(self, embedding, value: dict):
+        self.index.add(embedding.reshape(1, -1))
+        self.responses.append(value)
+
+    def save(self):
+        embeddings = self.index.reconstruct_n(0, self.index.ntotal)
+        temp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        with open(temp_file, "wb") as file:
+            pickle.dump((self.scope, embeddings, self.responses), file)
+        os.replace(temp_file, self.cache_file)
\ No newline at end of file
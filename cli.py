@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+from pathlib import Path
+
+# Only the lightweight ingest step is imported up front. Each step imports the rest of the pipeline itself,
+# so preprocess doesn't wait on pydantic or the Gemini SDK, and only steps that call the model construct one
+from process_notes import pre_process_notes
+
+STRUCTURED_DIR = Path(__file__).parent / "notes" / "structured"
+NOTES_FILE = STRUCTURED_DIR / "notes.jsonl"
+ALL_CATEGORIES_FILE = STRUCTURED_DIR / "all_categories.jsonl"
+MERGED_CATEGORIES_FILE = STRUCTURED_DIR / "merged_categories.json"
+EXTRACTIONS_FILE = STRUCTURED_DIR / "extractions.jsonl"
+
+# Options each phase accepts, named after its keyword arguments
+PHASE_1_OPTIONS = ("use_batch_api", "concurrency", "cache_dir", "semantic_cache", "batch_size", "resume")
+PHASE_3_OPTIONS = ("use_batch_api", "concurrency", "batch_size", "resume")
+PHASE_4_OPTIONS = ("concurrency",)
+
+def phase_options(args: argparse.Namespace, names: tuple) -> dict:
+    """The options given on the command line, leaving anything not given to the phase's own defaults"""
+    return {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+
+def positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def run_preprocess(args: argparse.Namespace):
+    pre_process_notes()
+
+def run_extract(args: argparse.Namespace):
+    from model import GeminiModel
+    from synthesis import read_jsonl, extract_categories
+
+    extract_categories(GeminiModel(), read_jsonl(NOTES_FILE), **phase_options(args, PHASE_1_OPTIONS))
+
+def run_merge(args: argparse.Namespace):
+    from model import GeminiModel
+    from synthesis import read_jsonl, merge_categories
+
+    merge_categories(GeminiModel(), read_jsonl(ALL_CATEGORIES_FILE))
+
+def run_details(args: argparse.Namespace):
+    from model import GeminiModel
+    from synthesis import load_json, read_jsonl, extract_details
+
+    extract_details(GeminiModel(), read_jsonl(NOTES_FILE), read_jsonl(ALL_CATEGORIES_FILE), load_json(MERGED_CATEGORIES_FILE),
+                    **phase_options(args, PHASE_3_OPTIONS))
+
+def run_generate(args: argparse.Namespace):
+    from model import GeminiModel
+    from synthesis import load_json, read_jsonl, generate_notes
+
+    generate_notes(GeminiModel(), load_json(MERGED_CATEGORIES_FILE), read_jsonl(EXTRACTIONS_FILE), **phase_options(args, PHASE_4_OPTIONS))
+
+async def run_phases(args: argparse.Namespace):
+    """Phases 1-4 back to back, each streaming the previous phase's output file"""
+    from model import GeminiModel
+    from synthesis import read_jsonl, extract_categories_async, merge_categories, extract_details_async, generate_notes_async
+
+    model = GeminiModel()
+    try:
+        all_categories_file = await extract_categories_async(model, read_jsonl(NOTES_FILE), **phase_options(args, PHASE_1_OPTIONS))
+        merged_categories = merge_categories(model, read_jsonl(all_categories_file))
+        extractions_file = await extract_details_async(model, read_jsonl(NOTES_FILE), read_jsonl(all_categories_file), merged_categories,
+                                                       **phase_options(args, PHASE_3_OPTIONS))
+        await generate_notes_async(model, merged_categories, read_jsonl(extractions_file), **phase_options(args, PHASE_4_OPTIONS))
+    finally:
+        # Release the model's async connections before the loop closes
+        await model.aclose()
+
+def run_all(args: argparse.Namespace):
+    pre_process_notes()
+    # One event loop for every phase, so the model's async client isn't carried across loops
+    asyncio.run(run_phases(args))
+
+COMMANDS = {
+    "preprocess": run_preprocess,
+    "extract": run_extract,
+    "merge": run_merge,
+    "details": run_details,
+    "generate": run_generate,
+    "all": run_all
+}
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Turn an inbox of markdown notes into a categorized library")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Options shared by the steps that call the model concurrently. Unset ones fall back to the phase's defaults
+    model_options = argparse.ArgumentParser(add_help=False)
+    model_options.add_argument("--concurrency", type=positive_int, help="Max number of requests in flight at once")
+    model_options.add_argument("--batch-size", type=positive_int, help="Number of notes packed into each request")
+    model_options.add_argument("--batch-api", dest="use_batch_api", action="store_true", help="Submit all requests as one batch job. Cheaper, but results can take a while")
+    model_options.add_argument("--fresh", dest="resume", action="store_false", help="Ignore results an interrupted run already wrote and start over")
+
+    # Options for Phase 1's response cache
+    cache_options = argparse.ArgumentParser(add_help=False)
+    cache_options.add_argument("--cache-dir", type=Path, help="Where cached responses are kept")
+    cache_options.add_argument("--semantic-cache", action="store_true", help="Also reuse responses for notes that closely match an earlier note. Needs sentence-transformers and faiss")
+
+    subparsers.add_parser("preprocess", help="Ingest notes from the inbox into notes.jsonl")
+    subparsers.add_parser("extract", parents=[model_options, cache_options], help="Phase 1: suggest categories for every note")
+    subparsers.add_parser("merge", help="Phase 2: merge the suggested categories into the final taxonomy")
+    subparsers.add_parser("details", parents=[model_options], help="Phase 3: pull each note's details into the final categories")
+    generate_parser = subparsers.add_parser("generate", help="Phase 4: write one consolidated note per category")
+    generate_parser.add_argument("--concurrency", type=positive_int, help="Max number of requests in flight at once")
+    subparsers.add_parser("all", parents=[model_options, cache_options], help="Ingest the inbox and run every phase")
+
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    COMMANDS[args.command](args)
+
+if __name__ == "__main__":
+    main()
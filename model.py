@@ -2,48 +2,263 @@ from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 import os
-from typing import Optional
+import time
+import math
+import hashlib
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+import orjson
 
 from abc import ABC, abstractmethod
 
 load_dotenv()
 API_KEY = os.environ.get('API_KEY')
+MODEL_NAME = "gemini-2.5-flash"
+
+# How often to check on a submitted batch job
+BATCH_POLL_SECONDS = 30
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# How long a cached system prompt stays available
+PROMPT_CACHE_TTL_SECONDS = 3600
+# Recreate a cached prompt this long before it expires, so no request points at a deleted cache
+PROMPT_CACHE_REFRESH_MARGIN = 300
+# Gemini 2.5 Flash only caches prompts at least this long. The phase prompts on their own fall short,
+# so in practice only Phase 3 with a very long category list gets cached
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+@lru_cache(maxsize=None)
+def _schema_for(response_schema: type) -> dict:
+    """Build the JSON schema for a Pydantic model once, then reuse it on every call"""
+    return response_schema.model_json_schema()
 
 class Model(ABC):
     """
     Interface for AI models.x
     """
+
+    # Identifies the underlying model, e.g. so cached responses from a different model aren't reused
+    name: str
     
     @abstractmethod
-    def invoke(self, system_prompt: str, payload: str, response_schema: Optional[type] = None) -> str:
+    def invoke(self, system_prompt: str, payload: str, response_schema: Optional[type] = None, cached_content: Optional[str] = None) -> Union[str, dict]:
         """
         Send a request to the model and return the response.
+        Returns the response text, or the parsed JSON when a response_schema is given.
         
         Args:
             system_prompt: The system instruction for the model
             payload: The user content/prompt
             response_schema: Optional Pydantic model class for structured output
+            cached_content: Optional handle from cache_prompt, used in place of sending system_prompt
+        """
+        pass
+
+    @abstractmethod
+    async def ainvoke(self, system_prompt: str, payload: str, response_schema: Optional[type] = None, cached_content: Optional[str] = None) -> Union[str, dict]:
+        """
+        Async version of invoke, used to run many requests concurrently.
+        
+        Args:
+            system_prompt: The system instruction for the model
+            payload: The user content/prompt
+            response_schema: Optional Pydantic model class for structured output
+            cached_content: Optional handle from cache_prompt, used in place of sending system_prompt
+        """
+        pass
+
+    def invoke_batch(self, system_prompt: str, payloads: List[str], response_schema: Optional[type] = None, cached_content: Optional[str] = None) -> list:
+        """
+        Send many independent requests that share a system prompt and return one response per payload.
+        A request that failed shows up as its exception instead of a response.
+
+        Models without a dedicated batch API fall back to calling invoke for each payload.
+        
+        Args:
+            system_prompt: The system instruction for the model
+            payloads: The user content/prompt for each request
+            response_schema: Optional Pydantic model class for structured output
+            cached_content: Optional handle from cache_prompt, used in place of sending system_prompt
+        """
+        responses = []
+        for payload in payloads:
+            try:
+                responses.append(self.invoke(system_prompt, payload, response_schema, cached_content))
+            except Exception as e:
+                responses.append(e)
+        return responses
+
+    async def cache_prompt(self, system_prompt: str) -> Optional[str]:
+        """
+        Upload a system prompt that is about to be reused across many requests, so it isn't billed in full every time.
+        Returns a handle to pass as cached_content, or None if the prompt can't be cached.
+        Cheap to call again with the same prompt, so callers can look the handle up again as a long run goes on.
+
+        Models without prompt caching always return None.
+        """
+        return None
+
+    async def aclose(self):
+        """
+        Release what the model holds for the current event loop, such as connections and cached prompts.
+        Call it before the loop ends. The model can still be used afterwards, including from another loop.
         """
         pass
 
 class GeminiModel(Model):
-    def invoke(self, system_prompt: str, payload: str, response_schema: Optional[type] = None) -> str:
-        client = genai.Client(api_key=API_KEY)
+    name = MODEL_NAME
 
-        # Set system prompt
-        config = types.GenerateContentConfig(
-            system_instruction=system_prompt
-        )
+    def __init__(self):
+        # Shared across calls so the underlying connection pool is reused. The async side of the pool belongs
+        # to the event loop it was first used in, so aclose drops the client and the next call creates a new one
+        self._client: Optional[genai.Client] = None
+
+        # Cached prompts keyed by a hash of their text: (cache name or None, time to recreate it).
+        # Editing a prompt changes its hash, so the stale cache is simply never looked up again
+        self._prompt_caches: Dict[str, Tuple[Optional[str], float]] = {}
+
+    def _get_client(self) -> genai.Client:
+        self._client = self._client or genai.Client(api_key=API_KEY)
+        return self._client
+
+    def _build_config(self, system_prompt: str, response_schema: Optional[type] = None, cached_content: Optional[str] = None) -> types.GenerateContentConfig:
+        # Set system prompt, or point at the cached copy of it
+        if cached_content:
+            config = types.GenerateContentConfig(
+                cached_content=cached_content
+            )
+        else:
+            config = types.GenerateContentConfig(
+                system_instruction=system_prompt
+            )
         
         # Enable structured output if schema is provided
         if response_schema:
             config.response_mime_type = "application/json"
-            config.response_json_schema = response_schema.model_json_schema()
+            config.response_json_schema = _schema_for(response_schema)
+
+        return config
+
+    def _read_response(self, response: types.GenerateContentResponse, response_schema: Optional[type] = None) -> Union[str, dict]:
+        if not response_schema:
+            return response.text
+
+        # Structured output already matches the schema and the SDK has parsed it, so use it as is
+        if response.parsed is None:
+            raise ValueError(f"Model did not return valid JSON: {response.text}")
+        return response.parsed
+
+    def invoke(self, system_prompt: str, payload: str, response_schema: Optional[type] = None, cached_content: Optional[str] = None) -> Union[str, dict]:
+        client = self._get_client()
+        config = self._build_config(system_prompt, response_schema, cached_content)
 
         response = client.models.generate_content(
-            model="gemini-2.5-flash", 
+            model=MODEL_NAME,
             config=config,
             contents=payload
         )
         
-        return response.text
\ No newline at end of file
+        return self._read_response(response, response_schema)
+
+    async def ainvoke(self, system_prompt: str, payload: str, response_schema: Optional[type] = None, cached_content: Optional[str] = None) -> Union[str, dict]:
+        client = self._get_client()
+        config = self._build_config(system_prompt, response_schema, cached_content)
+
+        response = await client.aio.models.generate_content(
+            model=MODEL_NAME,
+            config=config,
+            contents=payload
+        )
+        
+        return self._read_response(response, response_schema)
+
+    def invoke_batch(self, system_prompt: str, payloads: List[str], response_schema: Optional[type] = None, cached_content: Optional[str] = None) -> list:
+        """
+        Run the requests through Gemini's Batch Mode, which is cheaper and not bound by the sync rate limits,
+        but can take a while to complete.
+        """
+        client = self._get_client()
+        config = self._build_config(system_prompt, response_schema, cached_content)
+
+        inline_requests = [types.InlinedRequest(contents=payload, config=config) for payload in payloads]
+        job = client.batches.create(model=MODEL_NAME, src=inline_requests)
+        print(f"⏳ Submitted batch job {job.name} with {len(payloads)} requests")
+
+        # Poll until the job is done
+        while job.state.name not in BATCH_DONE_STATES:
+            time.sleep(BATCH_POLL_SECONDS)
+            job = client.batches.get(name=job.name)
+
+        if job.state.name not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            raise RuntimeError(f"Batch job {job.name} finished with state {job.state.name}: {job.error}")
+
+        responses = []
+        for inlined_response in job.dest.inlined_responses:
+            if inlined_response.error:
+                responses.append(RuntimeError(inlined_response.error.message))
+            elif response_schema:
+                # Batch responses come back unparsed
+                try:
+                    responses.append(orjson.loads(inlined_response.response.text))
+                except orjson.JSONDecodeError as e:
+                    responses.append(e)
+            else:
+                responses.append(inlined_response.response.text)
+        return responses
+
+    async def cache_prompt(self, system_prompt: str) -> Optional[str]:
+        prompt_hash = hashlib.sha256(system_prompt.encode()).hexdigest()
+        cached = self._prompt_caches.get(prompt_hash)
+        if cached and time.monotonic() < cached[1]:
+            return cached[0]
+
+        client = self._get_client()
+        try:
+            # Don't ask Gemini to cache a prompt it would refuse. A prompt's length never changes, so this is only checked once
+            count = await client.aio.models.count_tokens(model=MODEL_NAME, contents=system_prompt)
+            if count.total_tokens < PROMPT_CACHE_MIN_TOKENS:
+                self._prompt_caches[prompt_hash] = (None, math.inf)
+                return None
+
+            cache = await client.aio.caches.create(
+                model=MODEL_NAME,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_prompt,
+                    ttl=f"{PROMPT_CACHE_TTL_SECONDS}s"
+                )
+            )
+            name = cache.name
+        except Exception as e:
+            # Caching is only an optimization, so any failure, including network errors, just means sending the prompt in full.
+            # Remember the failure too, so we don't ask again every time the request window is topped up
+            print(f"⚠️ Could not cache prompt, sending it with every request instead: {e}")
+            name = None
+
+        self._prompt_caches[prompt_hash] = (name, time.monotonic() + PROMPT_CACHE_TTL_SECONDS - PROMPT_CACHE_REFRESH_MARGIN)
+
+        # The cache this one replaces would otherwise stay billed until it expires
+        if cached and cached[0]:
+            try:
+                await client.aio.caches.delete(name=cached[0])
+            except Exception as e:
+                print(f"⚠️ Could not delete replaced prompt cache {cached[0]}: {e}")
+
+        return name
+
+    async def aclose(self):
+        if not self._client:
+            return
+
+        # Cached prompts are billed until they expire, so delete them now that this run is done with them
+        for name, _ in self._prompt_caches.values():
+            if name:
+                try:
+                    await self._client.aio.caches.delete(name=name)
+                except Exception as e:
+                    print(f"⚠️ Could not delete prompt cache {name}: {e}")
+        self._prompt_caches.clear()
+
+        # Close both connection pools, since the client is dropped and the next call creates a new one
+        await self._client.aio.aclose()
+        self._client.close()
+        self._client = None
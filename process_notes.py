@@ -1,24 +1,83 @@
 from pathlib import Path
-import json
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import os
+
+# Reading and moving notes is disk-bound, so overlap it across threads
+MAX_IO_WORKERS = 32
+
+# Phase checkpoints that point at note IDs. They are stale as soon as a new notes.jsonl is written
+CHECKPOINT_FILES = ["all_categories.jsonl", "extractions.jsonl"]
+
+def read_note(entry: os.DirEntry) -> tuple:
+    """Returns the note's (title, content)"""
+    # Unbuffered, since the whole file is read in one go anyway
+    with open(entry.path, "rb", buffering=0) as file:
+        return entry.name, file.read().decode("utf-8")
+
+def processed_paths(note_files: list, notes_processed: Path) -> list:
+    """
+    Where each note is moved to in processed. A name that's already taken gets a numbered suffix,
+    since the earlier note's content only survives in processed once notes.jsonl is rewritten
+    """
+    taken = set(os.listdir(notes_processed))
+    paths = []
+    for entry in note_files:
+        stem, suffix = os.path.splitext(entry.name)
+        name = entry.name
+        copy_number = 2
+        while name in taken:
+            name = f"{stem} ({copy_number}){suffix}"
+            copy_number += 1
+        if name != entry.name:
+            print(f"⚠️ {entry.name} is already in processed, moving it there as {name}")
+        taken.add(name)
+        paths.append(os.path.join(notes_processed, name))
+    return paths
 
 def pre_process_notes():
     notes_inbox = Path(__file__).parent / "notes" / "inbox"
     notes_processed = Path(__file__).parent / "notes" / "processed"
-    output_file = Path(__file__).parent / "notes" / "structured" / "notes.json"
+    output_file = Path(__file__).parent / "notes" / "structured" / "notes.jsonl"
 
-    # Ingest all raw notes from inbox directory -> write their data to array -> move to processed
+    # Ingest all raw notes from inbox directory -> write their data to array -> move to processed.
+    # Each step finishes before the next starts, so a crash never leaves notes moved but unrecorded
+    # Not following symlinks lets is_file() answer from the directory listing, without a stat per entry
+    with os.scandir(notes_inbox) as entries:
+        note_files = [entry for entry in entries if entry.name.endswith(".md") and entry.is_file(follow_symlinks=False)]
+    # Read in inode order, which roughly follows on-disk layout, so reads are closer to sequential
+    note_files.sort(key=lambda entry: entry.inode())
+    # Work out where every note goes before anything is written, so an earlier note is never overwritten
+    destinations = processed_paths(note_files, notes_processed)
+    with ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as executor:
+        read_notes = list(executor.map(read_note, note_files))
+
+    # IDs are assigned once everything is read, so they stay dense and follow read order
     notes_array = []
-    for i, note_file in enumerate(notes_inbox.glob("*.md")):
+    for i, (title, content) in enumerate(read_notes):
         notes_array.append({
-            "title": note_file.name,
-            "content": note_file.read_text(encoding="utf-8"),
+            "title": title,
+            "content": content,
             "ID": i
         })
-        shutil.move(note_file, notes_processed)
 
-    # Write all ingested notes to notes.json file
-    with open(output_file, "w", encoding="utf-8") as file:
-        json.dump(notes_array, file, indent=2)
+    # Write all ingested notes to notes.jsonl, one note per line so later phases can stream them.
+    # Serialize everything up front so it goes to disk in a single write
+    payload = b"".join(orjson.dumps(note) + b"\n" for note in notes_array)
+
+    # Write to a temporary file and swap it in, so notes.jsonl is never seen half-written
+    temp_file = output_file.with_name(output_file.name + ".tmp")
+    temp_file.write_bytes(payload)
+    os.replace(temp_file, output_file)
+
+    # IDs start over with every ingest, so later phases must not resume from the previous notes
+    for checkpoint in CHECKPOINT_FILES:
+        output_file.with_name(checkpoint).unlink(missing_ok=True)
+
+    # Only move notes to processed once they are safely written out.
+    # inbox and processed share a parent, so a plain rename is enough
+    with ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as executor:
+        list(executor.map(lambda note_file, destination: os.rename(note_file.path, destination), note_files, destinations))
 
-pre_process_notes()
\ No newline at end of file
+if __name__ == "__main__":
+    pre_process_notes()
@@ -1,8 +1,20 @@
+from __future__ import annotations
 from pathlib import Path
-import json
-from model import Model, GeminiModel
+import asyncio
+import os
+import hashlib
+import aiofiles
+import orjson
+from cache import ResponseCache, SemanticCache, normalize_text
 from pydantic import BaseModel, Field
-from typing import List
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterable, Iterator, List, Optional, Tuple
+from itertools import chain, islice
+from collections import Counter, defaultdict
+from operator import itemgetter
+
+# Only needed for annotations. Importing model pulls in the Gemini SDK, which steps that don't call the model can skip
+if TYPE_CHECKING:
+    from model import Model
 
 class CategoryExtractionResponse(BaseModel):
     """Response model for extracted note categories"""
@@ -10,6 +22,10 @@ class CategoryExtractionResponse(BaseModel):
     unused: bool = Field(description="Whether the note should be marked as unused")
     ID: int = Field(description="The note ID")
 
+class BatchCategoryExtractionResponse(BaseModel):
+    """Response model for a batch of notes sent in a single request"""
+    results: List[CategoryExtractionResponse] = Field(description="One category extraction per note, in the order given")
+
 class MergedCategoryResponse(BaseModel):
     """Response model for merged note categories"""
     categories: List[str] = Field(description= "List of aggregated note catorgies")
@@ -24,8 +40,20 @@ class NoteCategorizationResponse(BaseModel):
     note_id: str = Field(description="The ID of the note being categorized")
     extractions: List[CategoryExtraction] = Field(description="List of category extractions from the note")
 
+class BatchNoteCategorizationResponse(BaseModel):
+    """Response model for a batch of categorized notes sent in a single request"""
+    results: List[NoteCategorizationResponse] = Field(description="One categorization per note, in the order given")
+
+class SynthesizedNoteResponse(BaseModel):
+    """Response model for the consolidated note of a category"""
+    category: str = Field(description="The category name")
+    synthesized_note: str = Field(description="The complete, synthesized note body in markdown format")
+    source_notes: List[str] = Field(description="IDs of the notes that contributed to the synthesized note")
+    item_count: int = Field(description="Number of distinct items in the synthesized note")
+
 PHASE_1_PROMPT = """
-Analyze this note and identify the PRIMARY category or categories it belongs to.
+You will be given a JSON array of notes, each with an ID, title and content.
+Analyze EACH note independently and identify the PRIMARY category or categories it belongs to.
 
 Guidelines:
 - Focus on the MAIN purpose/theme of the note, not every micro-topic mentioned
@@ -45,17 +73,7 @@ BAD - Over-fragmentation:
 - A note about a custom Ferrari → ["Ferrari", "Car Customization", "Automotive Design", "Color Analysis", "Design Aesthetics"] (TOO MANY - just use "Car Observations")
 - A philosophical thought → ["Philosophy", "Personal Musings", "Reflections", "Deep Thoughts"] (TOO MANY - just use "Personal Musings")
 
-Output format: Return ONLY valid JSON in this structure:
-{
-  "categories": ["Category 1", "Category 2"],
-  "unused": false
-}
-
-OR if the note should be marked as unused:
-{
-  "categories": [],
-  "unused": true
-}
+Output: Exactly one result per note, using the note's ID. Unused notes get an empty categories list.
 """
 
 PHASE_2_PROMPT = """
@@ -67,7 +85,7 @@ Rules:
 - Combine related micro-categories into broader themes (e.g., "Ferrari" + "Car Customization" + "Automotive Design" + "Automotive Observations" + "Color and Material Analysis" → "Car Observations")
 - Only keep categories separate if they represent FUNDAMENTALLY different purposes (e.g., "Movies to Watch" vs "Movie Reviews I Wrote" vs "Movie Quotes")
 - Typically aim for 8-15 final categories total - more than this suggests over-fragmentation
-- Prefer the most natural/common phrasing when merging
+- Prefer the most natural/common phrasing when merging - a higher count means the phrasing is more common
 
 Examples of aggressive merging:
 - "Books to Read" + "Reading List" + "Book Recommendations" + "Books I Want" → "Books to Read"
@@ -75,17 +93,20 @@ Examples of aggressive merging:
 - "Personal Musings" + "Reflections on Detail" + "Deep Thoughts" + "Random Thoughts" → "Personal Musings"
 - "Career Planning" + "Job Search" + "Post-Graduation Employment" → "Career Planning"
 
-Output format: Return ONLY a valid JSON array of category strings:
-["Category 1", "Category 2", "Category 3"]
+Output: The final list of merged category names.
+
+Input format: A JSON object mapping each category to the number of notes it was suggested for, most common first:
+{"Movies to Watch": 12, "Films to See": 3}
 
 Category list to merge:
 """
 
 PHASE_3_PROMPT = """
-You are analyzing a note to extract content relevant to specific categories.
+You are analyzing notes to extract content relevant to specific categories.
+You will be given a JSON array of notes, each with an ID, title and content. Handle EACH note independently.
 
 Task:
-1. Review the note against the provided category list
+1. Review each note against the category list at the end of these instructions
 2. Identify which category (or categories) this note PRIMARILY belongs to
 3. Extract the content ONCE per category - do not duplicate content across multiple categories
 4. If a note clearly belongs to just ONE category, only extract it to that one category
@@ -98,49 +119,20 @@ Guidelines:
 - If the note contains nothing relevant to any category, return an empty extractions array
 
 Examples:
-GOOD extraction:
 Note: "This Ferrari SF90 has a purple custom paint job with yellow accents"
-→ Extract ONCE to "Car Observations" (not also to "Color Analysis", "Ferrari", "Design", etc.)
+GOOD → Extract ONCE to "Car Observations"
+BAD → Extract to "Ferrari", "Car Customization", "Color Analysis", "Design Aesthetics" (TOO FRAGMENTED)
 
-BAD extraction (over-fragmentation):
-Note: "This Ferrari SF90 has a purple custom paint job with yellow accents"
-→ Extract to "Ferrari", "Car Customization", "Color Analysis", "Design Aesthetics" (TOO FRAGMENTED)
-
-Output format: Return ONLY valid JSON in this structure:
-{
-  "note_id": "the_note_id_here",
-  "extractions": [
-    {
-      "category": "Category Name",
-      "content": "The full relevant content from the note"
-    }
-  ]
-}
-
-Example JSON for multiple categories:
-{
-  "note_id": "note_456",
-  "extractions": [
-    {
-      "category": "Movies to Watch",
-      "content": "Blade Runner 2049 - heard it's visually stunning"
-    },
-    {
-      "category": "Quotes",
-      "content": "one giant leap for mankind"
-    },
-    {
-      "category": "Gift Ideas",
-      "content": "sci-fi art book for Dad's birthday"
-    }
-  ]
-}
+Note: "Blade Runner 2049 - heard it's visually stunning. Sci-fi art book for Dad's birthday"
+GOOD → "Movies to Watch": "Blade Runner 2049 - heard it's visually stunning", "Gift Ideas": "Sci-fi art book for Dad's birthday"
+
+Output: Exactly one result per note, with note_id set to the note's ID.
 """
 
 PHASE_4_PROMPT = """
 You are creating a consolidated note for the category: "{category_name}"
 
-You have been provided with multiple text excerpts from different source notes that all relate to this category. Your task is to:
+You will be given a JSON array of text excerpts from different source notes that all relate to this category, each with the note_id it came from. Your task is to:
 
 1. Synthesize all the excerpts into a single, well-organized note
 2. Preserve all unique information - don't drop any items or details
@@ -155,149 +147,486 @@ Guidelines:
 - Use formatting (lists, sections) if it improves readability
 - Preserve specific details (dates, names, context) from the original notes
 
-Output format: Return ONLY valid JSON:
-{
-  "category": "{category_name}",
-  "synthesized_note": "The complete, synthesized note body in markdown format",
-  "source_notes": ["note_id_1", "note_id_2", "note_id_3"],
-  "item_count": 5
-}
-
-Source excerpts:
-{excerpts_json}
+Output: The synthesized note in markdown, the note_ids of every source note it draws on, and the number of distinct items in it.
 """
+# Where the intermediate output of each phase lives
+STRUCTURED_DIR = Path(__file__).parent / "notes" / "structured"
+
+def load_checkpoint(path: Path) -> List[dict]:
+    """
+    Read the results an interrupted run already wrote to a JSON Lines file.
+    A partly written last line is dropped and cut from the file, so new results can be appended cleanly.
+    """
+    if not path.exists():
+        return []
+
+    results = []
+    complete_bytes = 0
+    with open(path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                results.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                break
+            complete_bytes += len(line)
+
+    os.truncate(path, complete_bytes)
+    return results
+
+def start_checkpoint(path: Path, key: str, resume: bool = True) -> List[dict]:
+    """
+    Get a JSON Lines checkpoint ready for a run, returning the results an interrupted run already wrote.
+    The checkpoint is cleared instead if resume is off, or if it was written under a different key,
+    e.g. with another prompt or model, since its results no longer match what this run would produce.
+    The key is kept in a file next to the checkpoint.
+    """
+    key_file = path.with_name(path.name + ".key")
+    if resume and key_file.exists() and key_file.read_text() == key:
+        return load_checkpoint(path)
+
+    path.unlink(missing_ok=True)
+    key_file.write_text(key)
+    return []
+
+# Flush checkpoints to disk after this many writes. Syncing every write would stall on the disk
+FSYNC_EVERY = 50
+
+class CheckpointWriter:
+    """Appends results to an open JSON Lines checkpoint file, forcing them to disk every FSYNC_EVERY writes"""
+
+    def __init__(self, file):
+        self.file = file
+        self.writes = 0
+
+    async def write(self, results: List[dict]):
+        await self.file.write(b"".join(orjson.dumps(result) + b"\n" for result in results))
+        self.writes += 1
+        if self.writes % FSYNC_EVERY == 0:
+            await self.sync()
+
+    async def sync(self):
+        await self.file.flush()
+        await asyncio.to_thread(os.fsync, self.file.fileno())
+
+# Where model responses are cached between runs
+CACHE_DIR = Path(__file__).parent / "cache"
+
+def load_json(path: Path):
+    """Read and parse a whole JSON file in one shot"""
+    return orjson.loads(path.read_bytes())
+
+def read_jsonl(path: Path) -> Iterator[dict]:
+    """Stream a JSON Lines file one record at a time"""
+    with open(path, "rb") as file:
+        for line in file:
+            if line.strip():
+                yield orjson.loads(line)
+
+# Default max number of requests in flight at once
+MAX_CONCURRENT_REQUESTS = 16
+
+# Default number of notes packed into a single request. Larger batches mean fewer requests,
+# but answer quality drops if a batch gets too big
+NOTES_PER_REQUEST = 10
+
+def batched(items: Iterable, size: int) -> Iterable[list]:
+    """Split items into lists of at most size elements"""
+    assert size >= 1, f"batch size must be at least 1, got {size}"
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+# Pulls the fields of a note out in one call
+note_fields = itemgetter("title", "content", "ID")
+
+# Below this many characters a note's content says too little on its own, so its title decides how it's categorized
+SHORT_NOTE_CHARS = 20
+
+def note_identity(title: str, content: str) -> str:
+    """What makes two notes the same note: their normalized content, plus the title when the content is empty or trivial"""
+    content = normalize_text(content)
+    if len(content) < SHORT_NOTE_CHARS:
+        return f"{normalize_text(title)}\0{content}"
+    return content
+
+def format_notes(notes: List[dict]) -> str:
+    """Format a batch of notes into a single payload, as a JSON array the model can key its answers by ID"""
+    PAYLOAD = []
+    for note in notes:
+        title, content, ID = note_fields(note)
+        PAYLOAD.append({"ID": ID, "title": title, "content": content})
+    # Compact JSON, since indentation only adds tokens to every request
+    return orjson.dumps(PAYLOAD).decode()
+
+def match_results(batch: List[dict], results: List[dict], id_field: str) -> List[Tuple[int, dict]]:
+    """
+    Pair each result of a batched request with the ID of the note it answers.
+    The model's IDs are only trusted if they match a note that was sent: results for any other ID are dropped,
+    and notes left without a result are logged so they can be picked up on the next run.
+    """
+    sent_ids = {str(note["ID"]): note["ID"] for note in batch}
+    matched = {}
+    unknown_ids = []
+    for result in results:
+        returned_id = str(result[id_field]).strip()
+        if returned_id not in sent_ids:
+            unknown_ids.append(result[id_field])
+        elif returned_id not in matched:
+            matched[returned_id] = result
+
+    if unknown_ids:
+        print(f"⚠️ Dropping results for notes that weren't in the request: {unknown_ids}")
+    missing_ids = [ID for returned_id, ID in sent_ids.items() if returned_id not in matched]
+    if missing_ids:
+        print(f"⚠️ Model returned no result for notes {missing_ids}")
+
+    return [(sent_ids[returned_id], result) for returned_id, result in matched.items()]
+
+def run_phase(model: Model, phase: Awaitable):
+    """
+    Run an async phase in an event loop of its own. The model's async connections belong to that loop,
+    so they're closed before it ends instead of being carried over to the next phase's loop
+    """
+    async def run():
+        try:
+            return await phase
+        finally:
+            await model.aclose()
+
+    return asyncio.run(run())
+
+class BatchFeed:
+    """
+    Packs notes into payloads lazily, only as the request window asks for the next one.
+    Each batch is kept under its payload index until its response is handled, so only notes in flight are held in memory
+    """
+
+    def __init__(self, notes: Iterable[dict], batch_size: int):
+        self.notes = notes
+        self.batch_size = batch_size
+        self.in_flight = {}
+        self.notes_sent = 0
+        self.requests = 0
+
+    def __iter__(self) -> Iterator[str]:
+        for batch in batched(self.notes, self.batch_size):
+            self.in_flight[self.requests] = batch
+            self.notes_sent += len(batch)
+            self.requests += 1
+            yield format_notes(batch)
+
+    def pop(self, index: int) -> List[dict]:
+        """The notes sent in the payload at index, no longer needed once its response is handled"""
+        return self.in_flight.pop(index)
+
+# Called with (payload index, response) as soon as each response arrives.
+# A failed request is passed as its exception
+ResponseHandler = Callable[[int, object], Awaitable[None]]
+
+async def invoke_concurrently(model: Model, system_prompt: str, payloads: Iterable[str], response_schema: type, on_response: ResponseHandler, concurrency: int = MAX_CONCURRENT_REQUESTS):
+    """
+    Send every payload to the model concurrently, keeping a rolling window of concurrency requests in flight.
+    A new request is only started once another finishes, so large inboxes never create all their tasks up front.
+
+    A failed request is handed to on_response as its exception instead of cancelling the rest.
+    """
+    assert concurrency >= 1, f"concurrency must be at least 1, got {concurrency}"
+    async def invoke_one(index: int, payload: str, cached_content: Optional[str]):
+        try:
+            response = await model.ainvoke(system_prompt, payload, response_schema=response_schema, cached_content=cached_content)
+        except Exception as e:
+            response = e
+        await on_response(index, response)
+
+    remaining = enumerate(payloads)
+    # Don't set up a cached prompt for nothing
+    first = next(remaining, None)
+    if first is None:
+        return
+    remaining = chain([first], remaining)
+    pending = set()
+
+    def top_up(cached_content: Optional[str]):
+        for index, payload in islice(remaining, concurrency - len(pending)):
+            pending.add(asyncio.create_task(invoke_one(index, payload, cached_content)))
+
+    # Every payload shares the system prompt, so it's cached before the first request if the model supports it.
+    # It's looked up again each time the window is topped up, so a long run switches to the refreshed cache before the old one expires
+    top_up(await model.cache_prompt(system_prompt))
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+        top_up(await model.cache_prompt(system_prompt))
+
+async def invoke_all(model: Model, system_prompt: str, payloads: Iterable[str], response_schema: type, on_response: ResponseHandler, use_batch_api: bool = False, concurrency: int = MAX_CONCURRENT_REQUESTS):
+    """
+    Send every payload to the model, either concurrently or as a single batch job
+
+    Args:
+        payloads: Can be lazy. They're only pulled as the request window frees up
+        on_response: Awaited with (payload index, response) for each response
+        use_batch_api: Submit through the model's batch API instead. Cheaper, but results can take a while.
+        concurrency: Max number of requests in flight at once when not using the batch API
+    """
+    if use_batch_api:
+        # A batch job is submitted in one go, so every payload is needed up front
+        payloads = list(payloads)
+        if not payloads:
+            return
+
+        # A batch job can take up to a day, far longer than a cached prompt lives, so the prompt is sent in full
+        responses = await asyncio.to_thread(model.invoke_batch, system_prompt, payloads, response_schema)
+        for index, response in enumerate(responses):
+            await on_response(index, response)
+    else:
+        await invoke_concurrently(model, system_prompt, payloads, response_schema, on_response, concurrency)
+
 # Phase 1
-# OUTPUT: all_categories.json
-def extract_categories(model: Model):
+# OUTPUT: all_categories.jsonl
+async def extract_categories_async(model: Model, notes: Iterable[dict], use_batch_api: bool = False, concurrency: int = MAX_CONCURRENT_REQUESTS, cache_dir: Path = CACHE_DIR, semantic_cache: bool = False, batch_size: int = NOTES_PER_REQUEST, resume: bool = True) -> Path:
     """
-    Extract categories from notes
+    Extract categories from notes. Notes that were already categorized on a previous run are served from the cache.
     
     Args:
         model: An object that implements the Model interface
+        notes: Notes from notes.jsonl, can be streamed
+        use_batch_api: Send all requests as one batch job instead of concurrently
+        concurrency: Max number of requests in flight at once
+        cache_dir: Where cached responses are kept
+        semantic_cache: Also reuse responses for notes that closely match an earlier note's meaning.
+            Needs sentence-transformers and faiss installed
+        batch_size: Number of notes packed into each request
+        resume: Keep results an interrupted run already wrote to all_categories.jsonl and skip those notes,
+            as long as that run used the same prompt and model
+
+    Returns:
+        Path to all_categories.jsonl. Results are streamed there as they arrive rather than kept in memory,
+        so read them back with read_jsonl. Lines are in completion order, not note order
     """
-    # Load notes.json
-    with open("notes/structured/notes.json", "r", encoding="utf-8") as file:
-        notes = json.load(file)
-
-    response_list = []
-    output_file = Path(__file__).parent / "notes" / "structured" / "all_categories.json"
-
-    # Loop through each note
+    output_file = STRUCTURED_DIR / "all_categories.jsonl"
+    cache = ResponseCache(cache_dir / "phase1")
+
+    # Pick up where an interrupted run with the same prompt and model left off
+    checkpoint_key = ResponseCache.key(PHASE_1_PROMPT, BatchCategoryExtractionResponse.__name__, model.name)
+    done_ids = {result["ID"] for result in start_checkpoint(output_file, checkpoint_key, resume)}
+
+    # Look every note up in the cache first. IDs are reassigned on every ingest, so they are left out of the key
+    cache_keys = {}
+    cached_results = []
+    uncached_notes = []
+    # Notes with identical content are only sent once, and the response is copied to every ID in the group.
+    # copies maps the ID that is sent to its whole group
+    groups = defaultdict(list)
+    copies = {}
     for note in notes:
-        title = (note["title"])
-        content = (note["content"])
-        ID = (note["ID"])
-
-        PAYLOAD = f"""
-        Note title: {title}
-        Note ID: {ID}
-        Note content: {content}
-        """
-
-        print(f"Invoking model for note {ID}")
-        response = model.invoke(PHASE_1_PROMPT, PAYLOAD, response_schema=CategoryExtractionResponse)
-        print(response)
-        
-        # Parse the structured JSON response
-        response_data = CategoryExtractionResponse.model_validate_json(response)
-        response_list.append(response_data.model_dump())
-
-        with open(output_file, "w", encoding="utf-8") as file:
-            json.dump(response_list, file, indent=2)
+        title, content, ID = note_fields(note)
+        if ID in done_ids:
+            continue
+
+        key = cache.key(PHASE_1_PROMPT, CategoryExtractionResponse.__name__, model.name, normalize_text(title), normalize_text(content))
+        cached = cache.get(key)
+        if cached is not None:
+            cached_results.append({**cached, "ID": ID})
+            continue
+
+        cache_keys[ID] = key
+        group = groups[hashlib.blake2b(note_identity(title, content).encode(), digest_size=16).digest()]
+        group.append(ID)
+        if len(group) == 1:
+            copies[ID] = group
+            uncached_notes.append(note)
+
+    # Then look the remaining notes up by meaning, to catch paraphrases and near-duplicates.
+    # Only the content is embedded, so empty or trivial notes, which are told apart by their title, are left out
+    similar_cache = None
+    note_embeddings = {}
+    similar_notes = [note for note in uncached_notes if len(normalize_text(note["content"])) >= SHORT_NOTE_CHARS]
+    if semantic_cache and similar_notes:
+        similar_cache = SemanticCache(cache_dir / "phase1_sem.pkl", scope=cache.key(PHASE_1_PROMPT, CategoryExtractionResponse.__name__, model.name))
+        embeddings = similar_cache.embed([normalize_text(note["content"]) for note in similar_notes])
+
+        similar_hits = set()
+        for note, embedding in zip(similar_notes, embeddings):
+            cached = similar_cache.get(embedding)
+            if cached is None:
+                note_embeddings[note["ID"]] = embedding
+            else:
+                similar_hits.add(note["ID"])
+                cached_results.extend({**cached, "ID": ID} for ID in copies[note["ID"]])
+        uncached_notes = [note for note in uncached_notes if note["ID"] not in similar_hits]
+
+    # Pack several notes into each payload, only as the request window frees up
+    feed = BatchFeed(uncached_notes, batch_size)
+
+    duplicates = len(cache_keys) - len(copies)
+    print(f"Invoking model for {len(uncached_notes)} notes ({len(cached_results)} cached, {duplicates} duplicates, {len(done_ids)} already done)")
+    async with aiofiles.open(output_file, "ab") as file:
+        checkpoint = CheckpointWriter(file)
+        await checkpoint.write(cached_results)
+        del cached_results
+
+        async def save_response(index: int, response):
+            batch = feed.pop(index)
+            if isinstance(response, Exception):
+                print(f"❌ Model call failed for notes {[note['ID'] for note in batch]}: {response}")
+                return
+            print(response)
+
+            # The structured response is already parsed and matches the schema. Copy each result to the duplicates of its note
+            results = [{**result, "ID": copy_ID} for ID, result in match_results(batch, response["results"], "ID") for copy_ID in copies[ID]]
+            if similar_cache:
+                for result in results:
+                    if result["ID"] in note_embeddings:
+                        similar_cache.put(note_embeddings[result["ID"]], result)
+
+            # Cache files are written in a thread, like the checkpoint below, so the disk never holds up the event loop
+            cache_entries = [(cache_keys[result["ID"]], result) for result in results if result["ID"] in cache_keys]
+            await asyncio.to_thread(cache.put_many, cache_entries)
+
+            # Checkpoint each response as it arrives, one result per line, without holding up the other requests
+            await checkpoint.write(results)
+
+        await invoke_all(model, PHASE_1_PROMPT, feed, BatchCategoryExtractionResponse, save_response, use_batch_api, concurrency)
+        await checkpoint.sync()
+    print(f"Sent {feed.notes_sent} notes in {feed.requests} requests")
+
+    if similar_cache:
+        similar_cache.save()
+
+    return output_file
+
+def extract_categories(model: Model, notes: Iterable[dict], use_batch_api: bool = False, concurrency: int = MAX_CONCURRENT_REQUESTS, cache_dir: Path = CACHE_DIR, semantic_cache: bool = False, batch_size: int = NOTES_PER_REQUEST, resume: bool = True) -> Path:
+    return run_phase(model, extract_categories_async(model, notes, use_batch_api, concurrency, cache_dir, semantic_cache, batch_size, resume))
 
 # Phase 2
 # OUTPUT: merged_categories.json
-def merge_categories(model: Model):
-    with open("notes/structured/all_categories.json", "r", encoding="utf-8") as file:
-        all_categories = json.load(file)
-    
-    output_file = Path(__file__).parent / "notes" / "structured" / "merged_categories.json"
+def merge_categories(model: Model, all_categories: Iterable[dict]) -> List[dict]:
+    output_file = STRUCTURED_DIR / "merged_categories.json"
     merged_category_list = []
 
-    # Extract only the categories field from each entry
-    all_categories_list = []
-    for entry in all_categories:
-        if not entry["unused"]:  # Skip unused notes
-            all_categories_list.extend(entry["categories"])
+    # Count how often each category was suggested, skipping unused notes, so duplicates are only sent once
+    category_counts = Counter(chain.from_iterable(entry["categories"] for entry in all_categories if not entry["unused"]))
     
-    # Convert to string for the model
-    response = model.invoke(PHASE_2_PROMPT, json.dumps(all_categories_list, indent=2), response_schema=MergedCategoryResponse)
-    response_data = MergedCategoryResponse.model_validate_json(response)
-    merged_category_list.append(response_data.model_dump())
+    # all_categories.jsonl is in completion order, so ties are broken by name to send the same payload every run.
+    # Sent as a compact {name: count} object, which repeats no keys per category
+    ranked_categories = sorted(category_counts.items(), key=lambda item: (-item[1], item[0]))
+    response = model.invoke(PHASE_2_PROMPT, orjson.dumps(dict(ranked_categories)).decode(), response_schema=MergedCategoryResponse)
+    merged_category_list.append(response)
+
+    output_file.write_bytes(orjson.dumps(merged_category_list, option=orjson.OPT_INDENT_2))
 
-    with open(output_file, "w", encoding="utf-8") as file:
-            json.dump(merged_category_list, file, indent=2)
+    return merged_category_list
 
 
 # Phase 3
-# OUTPUT: extractions.json
-def extract_details(model: Model):
-    with open("notes/structured/all_categories.json", "r", encoding="utf-8") as file:
-        all_categories = json.load(file)
-    
-    with open("notes/structured/merged_categories.json", "r", encoding="utf-8") as file:
-        merged_categories = json.load(file)
-        categories = merged_categories[0]["categories"]
-        categories_text = ", ".join(categories)
+# OUTPUT: extractions.jsonl
+async def extract_details_async(model: Model, notes: Iterable[dict], all_categories: Iterable[dict], merged_categories: List[dict], use_batch_api: bool = False, concurrency: int = MAX_CONCURRENT_REQUESTS, batch_size: int = NOTES_PER_REQUEST, resume: bool = True) -> Path:
+    """
+    Pull the excerpts for each category out of every used note. Results are streamed to extractions.jsonl
+    as they arrive rather than kept in memory, and the path to it is returned
+    """
+    categories = merged_categories[0]["categories"]
+    categories_text = ", ".join(categories)
 
-    with open("notes/structured/notes.json", "r", encoding="utf-8") as file:
-        notes = json.load(file)
+    # The category list is the same for every note, so send it once as part of the system prompt
+    system_prompt = f"""{PHASE_3_PROMPT}
+List of available categories: {categories_text}
+"""
 
-    output_file = Path(__file__).parent / "notes" / "structured" / "extractions.json"
+    output_file = STRUCTURED_DIR / "extractions.jsonl"
 
-    # Create list of unused IDs
-    unused_list = []
-    for entry in all_categories:
-        if entry["unused"] == True:
-            unused_list.append(entry["ID"])
+    # Pick up where an interrupted run left off. The system prompt includes the category list,
+    # so extractions made against an earlier taxonomy are thrown away
+    checkpoint_key = ResponseCache.key(system_prompt, BatchNoteCategorizationResponse.__name__, model.name)
+    done_ids = {result["note_id"] for result in start_checkpoint(output_file, checkpoint_key, resume)}
 
-    # Main logic -> Sending notes + categories to LLM
-    response_list = []
-    for note in notes:
-        # If note is unused in categorization step, do not send it
-        if (note["ID"]) in unused_list:
-            pass
-        else:
-            title = (note["title"])
-            content = (note["content"])
-            ID = (note["ID"])
-
-            PAYLOAD = f"""
-            List of available categories: {categories_text}
-
-            Note title: {title}
-            Note ID: {ID}
-            Note content: {content}
-            """
-
-            print(f"🛜 Invoking model for note: {ID}")
-            response = model.invoke(PHASE_3_PROMPT, PAYLOAD, response_schema=NoteCategorizationResponse)
-            
-            # Parse the structured JSON response
-            response_data = NoteCategorizationResponse.model_validate_json(response)
-            response_list.append(response_data.model_dump())
-
-            with open(output_file, "w", encoding="utf-8") as file:
-                json.dump(response_list, file, indent=2) 
+    # Create set of unused IDs
+    unused_ids = {entry["ID"] for entry in all_categories if entry["unused"]}
+
+    # Main logic -> Sending notes + categories to LLM.
+    # If note is unused in categorization step, or was already extracted, do not send it.
+    # Notes are streamed, filtered and packed into payloads only as the request window frees up
+    used_notes = (note for note in notes if note["ID"] not in unused_ids and str(note["ID"]) not in done_ids)
+    feed = BatchFeed(used_notes, batch_size)
+
+    print(f"🛜 Invoking model for notes in batches of {batch_size} ({len(done_ids)} already done)")
+    async with aiofiles.open(output_file, "ab") as file:
+        checkpoint = CheckpointWriter(file)
+
+        async def save_response(index: int, response):
+            batch = feed.pop(index)
+            if isinstance(response, Exception):
+                print(f"❌ Model call failed for notes {[note['ID'] for note in batch]}: {response}")
+                return
+
+            # The structured response is already parsed and matches the schema.
+            # note_id is free text, so it's rewritten to the note's own ID for resume to recognize it
+            results = [{**result, "note_id": str(ID)} for ID, result in match_results(batch, response["results"], "note_id")]
+
+            # Checkpoint each response as it arrives, one result per line, without holding up the other requests
+            await checkpoint.write(results)
+
+        await invoke_all(model, system_prompt, feed, BatchNoteCategorizationResponse, save_response, use_batch_api, concurrency)
+        await checkpoint.sync()
+    print(f"🛜 Sent {feed.notes_sent} notes in {feed.requests} requests")
+
+    return output_file
+
+def extract_details(model: Model, notes: Iterable[dict], all_categories: Iterable[dict], merged_categories: List[dict], use_batch_api: bool = False, concurrency: int = MAX_CONCURRENT_REQUESTS, batch_size: int = NOTES_PER_REQUEST, resume: bool = True) -> Path:
+    return run_phase(model, extract_details_async(model, notes, all_categories, merged_categories, use_batch_api, concurrency, batch_size, resume))
 
 # Phase 4
 # OUTPUT: final_taxonomy.json
-def generate_notes(mode: Model):
-    with open("notes/structured/merged_categories.json", "r", encoding="utf-8") as file:
-        merged_categories = json.load(file)
-        categories = merged_categories[0]["categories"]
-    
-    with open("notes/structured/extractions.json", "r", encoding="utf-8") as file:
-        extractions = json.load(file)
+async def generate_notes_async(model: Model, merged_categories: List[dict], extractions: Iterable[dict], concurrency: int = MAX_CONCURRENT_REQUESTS) -> Path:
+    """
+    Synthesize one consolidated note per category from the excerpts Phase 3 extracted,
+    and write them to final_taxonomy.json in taxonomy order. Returns the path to it
+    """
+    categories = merged_categories[0]["categories"]
 
-    
-    
-    pass
+    # Map each category to its name in the final taxonomy, ignoring case differences in what the model returned
+    category_mapping = {category.casefold(): category for category in categories}
+
+    # Group every extracted excerpt under its category, keeping the note it came from
+    organized_notes = {category: [] for category in categories}
+    for extraction in extractions:
+        for item in extraction["extractions"]:
+            category = category_mapping.get(item["category"].casefold(), item["category"])
+            organized_notes.setdefault(category, []).append({"note_id": extraction["note_id"], "content": item["content"]})
 
-def testOutput(model: Model):
-    with open("notes/structured/merged_categories.json", "r", encoding="utf-8") as file:
-        merged_categories = json.load(file)
+    # extractions.jsonl is in completion order, so put each category's excerpts back in note order.
+    # The sort is stable, so excerpts from the same note keep their order
+    for excerpts in organized_notes.values():
+        excerpts.sort(key=lambda excerpt: int(excerpt["note_id"]))
 
+    # Each category gets its own system prompt, so they're sent side by side here instead of through invoke_all
+    assert concurrency >= 1, f"concurrency must be at least 1, got {concurrency}"
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def synthesize(category: str, excerpts: List[dict]):
+        async with semaphore:
+            try:
+                return await model.ainvoke(PHASE_4_PROMPT.format(category_name=category), orjson.dumps(excerpts).decode(), response_schema=SynthesizedNoteResponse)
+            except Exception as e:
+                print(f"❌ Model call failed for category {category}: {e}")
+                return None
+
+    used_categories = {category: excerpts for category, excerpts in organized_notes.items() if excerpts}
+    print(f"🛜 Synthesizing notes for {len(used_categories)} categories")
+    responses = await asyncio.gather(*(synthesize(category, excerpts) for category, excerpts in used_categories.items()))
+
+    output_file = STRUCTURED_DIR / "final_taxonomy.json"
+    output_file.write_bytes(orjson.dumps([response for response in responses if response is not None], option=orjson.OPT_INDENT_2))
+
+    return output_file
+
+def generate_notes(model: Model, merged_categories: List[dict], extractions: Iterable[dict], concurrency: int = MAX_CONCURRENT_REQUESTS) -> Path:
+    return run_phase(model, generate_notes_async(model, merged_categories, extractions, concurrency))
+
+def testOutput(model: Model, merged_categories: List[dict]):
     categories = merged_categories[0]["categories"]
     categories_text = ", ".join(categories)
 
@@ -310,15 +639,23 @@ def testOutput(model: Model):
 
 # Example usage:
 if __name__ == "__main__":
+    from model import GeminiModel
+
     # Create an instance of your model
     gemini_model = GeminiModel()
+
+    # JSON Lines files are streamed, so each phase gets its own reader.
+    # Phases 1 and 3 write their results straight to disk and return the file to read them back from
+    notes_file = STRUCTURED_DIR / "notes.jsonl"
+    all_categories_file = STRUCTURED_DIR / "all_categories.jsonl"
+    merged_categories = load_json(STRUCTURED_DIR / "merged_categories.json")
     
     # Pass it to your function
 
-    #extract_categories(gemini_model)
-    #merge_categories(gemini_model)
-    extract_details(gemini_model)
+    #all_categories_file = extract_categories(gemini_model, read_jsonl(notes_file))
+    #merged_categories = merge_categories(gemini_model, read_jsonl(all_categories_file))
+    extract_details(gemini_model, read_jsonl(notes_file), read_jsonl(all_categories_file), merged_categories)
     
     # The beauty: You could easily swap to a different model later!
     # different_model = OpenAIModel()  # hypothetical
-    # extract_categories(different_model)  # works the same way!
\ No newline at end of file
+    # extract_categories(different_model, read_jsonl(notes_file))  # works the same way!
\ No newline at end of file